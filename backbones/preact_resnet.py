@@ -53,7 +53,7 @@ class PreActBasicBlock(nn.Module):
         self.conv1 = conv3x3(in_channels, out_channels, 2 if reduce else 1)
         self.bn2 = nn.BatchNorm2d(out_channels)
         self.conv2 = conv3x3(out_channels, out_channels, 1)
-        self.shortcut = nn.Sequential()
+        self.shortcut = nn.Identity()
         if reduce or in_channels != out_channels:
             self.shortcut = nn.Sequential(
                 nn.BatchNorm2d(in_channels),
@@ -76,7 +76,7 @@ class PreActBottleneckBlock(nn.Module):
         self.conv2 = conv3x3(mid_channels, mid_channels, 1)
         self.bn3 = nn.BatchNorm2d(mid_channels)
         self.conv3 = conv1x1(mid_channels, out_channels, 1)
-        self.shortcut = nn.Sequential()
+        self.shortcut = nn.Identity()
         if reduce or in_channels != out_channels:
             self.shortcut = nn.Sequential(
                 conv1x1(in_channels, out_channels, 2 if reduce else 1),
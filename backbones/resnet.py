@@ -10,31 +10,36 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_conv_bn_weights
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152']
 
 
-def weights_init(m):
-    classname = m.__class__.__name__
-    if classname.find('Conv') != -1:
-        nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-    elif classname.find('BatchNorm') != -1:
-        nn.init.constant_(m.weight, 1)
-        nn.init.constant_(m.bias, 0)
+def init_conv(conv: nn.Conv2d):
+    """ Kaiming init at construction time; BatchNorm layers already default to weight=1, bias=0 """
+    nn.init.kaiming_normal_(conv.weight, mode='fan_out', nonlinearity='relu')
+    return conv
+
+
+def fuse_conv_bn(module: nn.Module, conv_name: str, bn_name: str):
+    """ Fold `module.<bn_name>` into `module.<conv_name>` and replace the former by an identity """
+    conv, bn = getattr(module, conv_name), getattr(module, bn_name)
+    setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+    setattr(module, bn_name, nn.Identity())
 
 
 def conv3x3(in_channels: int, out_channels: int, stride: int):
-    return nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=stride, padding=1, bias=False)
+    return init_conv(nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=stride, padding=1, bias=False))
 
 
 def conv1x1(in_channels: int, out_channels: int, stride: int):
-    return nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=stride, bias=False)
+    return init_conv(nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=stride, bias=False))
 
 
 def imagenet_first_block():
     """ 3x224x224 -> 64x112x112 -> 64x64x64 """
     return nn.Sequential(
-        nn.Conv2d(3, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False),
+        init_conv(nn.Conv2d(3, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False)),
         nn.BatchNorm2d(64),
         nn.ReLU(inplace=True),
         nn.MaxPool2d(kernel_size=3, stride=2, padding=1),
@@ -44,7 +49,7 @@ def imagenet_first_block():
 def cifar10_first_block():
     """ 3x32x32 -> 64x32x32 """
     return nn.Sequential(
-        nn.Conv2d(3, 64, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False),
+        init_conv(nn.Conv2d(3, 64, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1), bias=False)),
         nn.BatchNorm2d(64),
         nn.ReLU(inplace=True),
     )
@@ -57,17 +62,24 @@ class BasicBlock(nn.Module):
         self.bn1 = nn.BatchNorm2d(out_channels)
         self.conv2 = conv3x3(out_channels, out_channels, 1)
         self.bn2 = nn.BatchNorm2d(out_channels)
-        self.shortcut = nn.Sequential()
+        self.shortcut = nn.Identity()
         if reduce or in_channels != out_channels:
             self.shortcut = nn.Sequential(
                 conv1x1(in_channels, out_channels, 2 if reduce else 1),
                 nn.BatchNorm2d(out_channels),
             )
 
+    def conv_bn_pairs(self):
+        yield self, 'conv1', 'bn1'
+        yield self, 'conv2', 'bn2'
+        if isinstance(self.shortcut, nn.Sequential):
+            yield self.shortcut, '0', '1'
+
     def forward(self, x: Tensor):
         out = F.relu(self.bn1(self.conv1(x)), inplace=True)
-        out = F.relu(self.bn2(self.conv2(out)) + self.shortcut(x), inplace=True)
-        return out
+        out = self.bn2(self.conv2(out))
+        out += self.shortcut(x)
+        return F.relu(out, inplace=True)
 
 
 class BottleneckBlock(nn.Module):
@@ -79,18 +91,26 @@ class BottleneckBlock(nn.Module):
         self.bn2 = nn.BatchNorm2d(mid_channels)
         self.conv3 = conv1x1(mid_channels, out_channels, 1)
         self.bn3 = nn.BatchNorm2d(out_channels)
-        self.shortcut = nn.Sequential()
+        self.shortcut = nn.Identity()
         if reduce or in_channels != out_channels:
             self.shortcut = nn.Sequential(
                 conv1x1(in_channels, out_channels, 2 if reduce else 1),
                 nn.BatchNorm2d(out_channels),
             )
 
+    def conv_bn_pairs(self):
+        yield self, 'conv1', 'bn1'
+        yield self, 'conv2', 'bn2'
+        yield self, 'conv3', 'bn3'
+        if isinstance(self.shortcut, nn.Sequential):
+            yield self.shortcut, '0', '1'
+
     def forward(self, x: Tensor):
         out = F.relu(self.bn1(self.conv1(x)), inplace=True)
         out = F.relu(self.bn2(self.conv2(out)), inplace=True)
-        out = F.relu(self.bn3(self.conv3(out)) + self.shortcut(x), inplace=True)
-        return out
+        out = self.bn3(self.conv3(out))
+        out += self.shortcut(x)
+        return F.relu(out, inplace=True)
 
 
 class ResNet(nn.Module):
@@ -108,19 +128,41 @@ class ResNet(nn.Module):
             self.conv3_x = self._make_layer(BottleneckBlock, n_blocks[1], [256, 128, 512], reduce=True)
             self.conv4_x = self._make_layer(BottleneckBlock, n_blocks[2], [512, 256, 1024], reduce=True)
             self.conv5_x = self._make_layer(BottleneckBlock, n_blocks[3], [1024, 512, 2048], reduce=True)
-        self.avgpool = nn.AdaptiveAvgPool2d(1)
-        self.flatten = nn.Flatten()
         self.fc = nn.Linear(512 if block_type == 'basic' else 2048, n_classes)
-        self.apply(weights_init)
 
     @staticmethod
     def _make_layer(ResidualBlock, n_block: int, channels: List[int], reduce: bool):
-        layers = []
-        for _ in range(n_block):
-            layers.append(ResidualBlock(*channels, reduce=reduce))
-            channels[0] = channels[-1]
-            reduce = False
-        return nn.Sequential(*layers)
+        # only the first block changes the number of channels and reduces the resolution
+        block_args = [(channels, reduce)] + [([channels[-1]] + channels[1:], False)] * (n_block - 1)
+        return nn.Sequential(*[ResidualBlock(*chs, reduce=r) for chs, r in block_args])
+
+    @torch.no_grad()
+    def fuse(self):
+        """ Fold all BatchNorm layers into the preceding convolutions in place. Inference only. """
+        assert not self.training, 'fuse() can only be applied in eval mode'
+        for module, conv_name, bn_name in list(self.conv_bn_pairs()):
+            fuse_conv_bn(module, conv_name, bn_name)
+        return self
+
+    @torch.no_grad()
+    def load_fused_weights(self, model: 'ResNet'):
+        """ Fold the weights of an unfused `model` into this fused ResNet in place, without copying `model` """
+        for (module, conv_name, _), (src, src_conv_name, src_bn_name) in zip(self.conv_bn_pairs(), model.conv_bn_pairs()):
+            src_conv, src_bn = getattr(src, src_conv_name), getattr(src, src_bn_name)
+            weight, bias = fuse_conv_bn_weights(
+                src_conv.weight, src_conv.bias, src_bn.running_mean, src_bn.running_var,
+                src_bn.eps, src_bn.weight, src_bn.bias,
+            )
+            getattr(module, conv_name).weight.copy_(weight)
+            getattr(module, conv_name).bias.copy_(bias)
+        self.fc.load_state_dict(model.fc.state_dict())
+
+    def conv_bn_pairs(self):
+        """ Yield (parent module, conv name, bn name) for every Conv-BN pair """
+        yield self.first_block, '0', '1'
+        for m in self.modules():
+            if isinstance(m, (BasicBlock, BottleneckBlock)):
+                yield from m.conv_bn_pairs()
 
     def forward(self, x: Tensor):
         x = self.first_block(x)
@@ -128,8 +170,7 @@ class ResNet(nn.Module):
         x = self.conv3_x(x)
         x = self.conv4_x(x)
         x = self.conv5_x(x)
-        x = self.avgpool(x)
-        x = self.flatten(x)
+        x = x.mean(dim=(2, 3))
         x = self.fc(x)
         return x
 
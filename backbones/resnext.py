@@ -58,7 +58,7 @@ class BottleneckBlock(nn.Module):
         self.bn2 = nn.BatchNorm2d(mid_channels)
         self.conv3 = conv1x1(mid_channels, out_channels, 1)
         self.bn3 = nn.BatchNorm2d(out_channels)
-        self.shortcut = nn.Sequential()
+        self.shortcut = nn.Identity()
         if reduce or in_channels != out_channels:
             self.shortcut = nn.Sequential(
                 conv1x1(in_channels, out_channels, 2 if reduce else 1),
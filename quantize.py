@@ -0,0 +1,105 @@
+import os
+import copy
+import time
+import tqdm
+import argparse
+from omegaconf import OmegaConf
+
+import torch
+from torch.utils.data import DataLoader
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from metrics import Accuracy
+from tools import build_model
+from utils.data import load_data
+from utils.misc import set_seed
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, required=True, help='Path to config file')
+    parser.add_argument('-w', '--weights', type=str, required=True, help='Path to the model checkpoint (model.pt)')
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'qnnpack'], help='Quantization backend')
+    parser.add_argument('--n_calib_batches', type=int, default=100, help='Number of batches used for calibration')
+    parser.add_argument('--save', type=str, help='Path to save the quantized model as TorchScript')
+    parser.add_argument('--onnx', type=str, help='Path to export the quantized model in ONNX format')
+    return parser
+
+
+@torch.inference_mode()
+def evaluate(model, dataloader):
+    accuracy_fn = Accuracy(topk=(1, 5), reduction='sum')
+    acc1, acc5, n, elapsed = 0., 0., 0, 0.
+    for x, y in tqdm.tqdm(dataloader, desc='Evaluating', leave=False):
+        start = time.perf_counter()
+        logits = model(x)
+        elapsed += time.perf_counter() - start
+        batch_acc1, batch_acc5 = accuracy_fn(logits, y)
+        acc1, acc5, n = acc1 + batch_acc1.item(), acc5 + batch_acc5.item(), n + x.shape[0]
+    return {
+        'acc@1': acc1 / n,
+        'acc@5': acc5 / n,
+        'latency(ms/img)': elapsed / n * 1000,
+    }
+
+
+def main():
+    # PARSE ARGS AND CONFIGS
+    args, unknown_args = get_parser().parse_known_args()
+    unknown_args = [(a[2:] if a.startswith('--') else a) for a in unknown_args]
+    unknown_args = [f'{k}={v}' for k, v in zip(unknown_args[::2], unknown_args[1::2])]
+    conf = OmegaConf.load(args.config)
+    conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(unknown_args))
+    set_seed(conf.seed)
+
+    # SET QUANTIZATION BACKEND (int8 kernels run on cpu)
+    torch.backends.quantized.engine = args.backend
+
+    # BUILD DATASET & DATALOADER
+    train_set = load_data(conf.data, split='train')
+    valid_set = load_data(conf.data, split='valid')
+    train_loader = DataLoader(train_set, batch_size=conf.train.batch_size, shuffle=True, drop_last=True, **conf.dataloader)
+    valid_loader = DataLoader(valid_set, batch_size=conf.train.batch_size, shuffle=False, drop_last=False, **conf.dataloader)
+
+    # BUILD MODEL
+    model = build_model(conf)
+    ckpt = torch.load(args.weights, map_location='cpu', weights_only=True)
+    model.load_state_dict(ckpt['model'])
+    model.eval()
+    print(f'Successfully load model from {args.weights}')
+
+    # QUANTIZE
+    # prepare_fx folds conv-bn(-relu) itself, so the model must not be fused beforehand
+    example_inputs = (next(iter(valid_loader))[0], )
+    qconfig_mapping = get_default_qconfig_mapping(args.backend)
+    quantized_model = prepare_fx(copy.deepcopy(model), qconfig_mapping, example_inputs)
+    with torch.inference_mode():
+        for i, (x, _) in enumerate(tqdm.tqdm(train_loader, desc='Calibrating', total=args.n_calib_batches)):
+            if i >= args.n_calib_batches:
+                break
+            quantized_model(x)
+    quantized_model = convert_fx(quantized_model)
+
+    # EVALUATE
+    for name, m in [('fp32', model), ('int8', quantized_model)]:
+        status = evaluate(m, valid_loader)
+        print(f'[{name}] ' + ', '.join(f'{k}: {v:.6f}' for k, v in status.items()))
+
+    # EXPORT
+    if args.save is not None:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        torch.jit.save(torch.jit.trace(quantized_model, example_inputs), args.save)
+        print(f'Quantized model saved to {args.save}')
+    if args.onnx is not None:
+        os.makedirs(os.path.dirname(args.onnx) or '.', exist_ok=True)
+        torch.onnx.export(
+            quantized_model, example_inputs, args.onnx, opset_version=13,
+            input_names=['input'], output_names=['logits'],
+            dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+        )
+        print(f'Quantized model exported to {args.onnx}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import os
+import copy
 import tqdm
 import argparse
 from omegaconf import OmegaConf
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -12,7 +14,7 @@ from tools import build_model, build_optimizer, build_scheduler
 from utils.data import load_data
 from utils.logger import get_logger
 from utils.tracker import StatusTracker
-from utils.misc import get_time_str, check_freq, set_seed
+from utils.misc import get_time_str, check_freq, set_seed, copy_to_cpu, atomic_save
 from utils.experiment import create_exp_dir, find_resume_checkpoint
 
 
@@ -39,6 +41,7 @@ def main():
     # SET DEVICE
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f'Using device: {device}', flush=True)
+    torch.backends.cudnn.benchmark = True
 
     # CREATE EXPERIMENT DIRECTORY
     exp_dir = args.exp_dir
@@ -80,12 +83,19 @@ def main():
     optimizer = build_optimizer(model.parameters(), conf)
     scheduler = build_scheduler(optimizer, conf)
     model.to(device)
+    model.to(memory_format=torch.channels_last)
+    amp_dtype = getattr(torch, getattr(conf.train, 'amp_dtype', 'float32'))
+    use_amp = device.type == 'cuda' and amp_dtype != torch.float32
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
     logger.info('=' * 19 + ' Model Info ' + '=' * 19)
     logger.info(f'Number of parameters of model: {sum(p.numel() for p in model.parameters()):,}')
+    logger.info(f'Mixed precision: {amp_dtype if use_amp else "disabled"}')
     logger.info('=' * 50)
 
     # RESUME TRAINING
     step, best_acc = 0, 0.
+    # raw EMA of the training accuracy and the number of updates, for bias correction
+    train_acc_ema, train_acc_ema_steps = torch.zeros((), device=device), 0
     if args.resume is not None:
         resume_path = find_resume_checkpoint(exp_dir, args.resume)
         logger.info(f'Resume from {resume_path}')
@@ -93,12 +103,18 @@ def main():
         ckpt = torch.load(os.path.join(resume_path, 'model.pt'), map_location='cpu', weights_only=True)
         model.load_state_dict(ckpt['model'])
         logger.info(f'Successfully load model from {resume_path}')
-        # load training states (optimizer, scheduler, step, best_acc)
+        # load training states (optimizer, scheduler, scaler, step, best_acc, train_acc_ema)
         ckpt = torch.load(os.path.join(resume_path, 'training_states.pt'), map_location='cpu', weights_only=True)
         optimizer.load_state_dict(ckpt['optimizer'])
         scheduler.load_state_dict(ckpt['scheduler'])
+        if ckpt.get('scaler'):
+            # a disabled scaler saves an empty state, which an enabled scaler refuses to load
+            scaler.load_state_dict(ckpt['scaler'])
         step = ckpt['step'] + 1
         best_acc = ckpt['best_acc']
+        if 'train_acc_ema' in ckpt:
+            train_acc_ema.copy_(ckpt['train_acc_ema'])
+            train_acc_ema_steps = ckpt['train_acc_ema_steps']
         logger.info(f'Successfully load optimizer from {resume_path}')
         logger.info(f'Successfully load scheduler from {resume_path}')
         logger.info(f'Restart training at step {step}')
@@ -109,67 +125,130 @@ def main():
     cross_entropy = nn.CrossEntropyLoss().to(device)
     accuracy_fn = Accuracy(topk=(1, 5), reduction='none')
 
+    # PREPARE MODELS FOR TRAINING AND EVALUATION
+    # the original `model` is kept uncompiled and unfused for checkpointing
+    def fuse_model():
+        # fold BatchNorm into convolutions on a copy so that the training model is untouched
+        if not hasattr(model, 'fuse'):
+            return model
+        return copy.deepcopy(model).eval().fuse()
+
+    def update_eval_model():
+        # fold the latest weights into the persistent evaluation model in place
+        if fused_model is not model:
+            fused_model.load_fused_weights(model)
+
+    train_model, fused_model = model, fuse_model()
+    eval_model = fused_model
+    if getattr(conf.train, 'compile', False):
+        train_model = torch.compile(model, mode='max-autotune')
+    if device.type == 'cuda':
+        eval_model = torch.compile(fused_model, mode='reduce-overhead', fullgraph=False)
+
     # TRAINING FUNCTIONS
+    # checkpoints are written by a background thread, one at a time
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_futures = []
+
+    def wait_for_ckpt():
+        # re-raise errors in the background thread, if any
+        while ckpt_futures:
+            ckpt_futures.pop(0).result()
+
     def save_ckpt(save_path: str):
+        wait_for_ckpt()
         os.makedirs(save_path, exist_ok=True)
-        # save model
-        torch.save(dict(
+        # copy states to cpu on the main thread, since training will modify them in place
+        model_state = copy_to_cpu(dict(
             model=model.state_dict(),
-        ), os.path.join(save_path, 'model.pt'))
-        # save training states (optimizer, scheduler, step, best_acc)
-        torch.save(dict(
+        ))
+        training_states = copy_to_cpu(dict(
             optimizer=optimizer.state_dict(),
             scheduler=scheduler.state_dict(),
+            scaler=scaler.state_dict(),
             step=step,
             best_acc=best_acc,
-        ), os.path.join(save_path, 'training_states.pt'))
+            train_acc_ema=train_acc_ema,
+            train_acc_ema_steps=train_acc_ema_steps,
+        ))
+        # save model
+        ckpt_futures.append(ckpt_executor.submit(atomic_save, model_state, os.path.join(save_path, 'model.pt')))
+        # save training states (optimizer, scheduler, scaler, step, best_acc, train_acc_ema)
+        ckpt_futures.append(ckpt_executor.submit(atomic_save, training_states, os.path.join(save_path, 'training_states.pt')))
 
     def train_step(batch):
-        x = batch[0].float().to(device)
-        y = batch[1].long().to(device)
-        logits = model(x)
-        loss = cross_entropy(logits, y)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        x = batch[0].to(device, dtype=torch.float32, memory_format=torch.channels_last, non_blocking=True)
+        y = batch[1].to(device, dtype=torch.long, non_blocking=True)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            logits = train_model(x)
+            loss = cross_entropy(logits, y)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
-        return dict(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        acc1 = accuracy_fn(logits.detach(), y)[0].mean()
+        train_acc_ema.mul_(0.98).add_(acc1, alpha=0.02)
+        return loss.detach()
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def evaluate(dataloader):
-        acc1_list, acc5_list = [], []
+        sum1, sum5, n = torch.zeros((), device=device), torch.zeros((), device=device), 0
         for x, y in tqdm.tqdm(dataloader, desc='Evaluating', leave=False):
-            x, y = x.float().to(device), y.long().to(device)
-            logits = model(x)
+            x = x.to(device, dtype=torch.float32, memory_format=torch.channels_last, non_blocking=True)
+            y = y.to(device, dtype=torch.long, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                logits = eval_model(x)
             acc1, acc5 = accuracy_fn(logits, y)
-            acc1_list.append(acc1)
-            acc5_list.append(acc5)
-        acc1_list = torch.cat(acc1_list).cpu()
-        acc5_list = torch.cat(acc5_list).cpu()
+            sum1 += acc1.sum()
+            sum5 += acc5.sum()
+            n += acc1.numel()
         return {
-            'acc@1': acc1_list.mean().item(),
-            'acc@5': acc5_list.mean().item(),
+            'acc@1': (sum1 / n).item(),
+            'acc@5': (sum5 / n).item(),
         }
 
     # START TRAINING
+    # bind the frequently accessed config values to locals, as OmegaConf attribute access is slow
+    n_steps = int(conf.train.n_steps)
+    eval_freq = int(conf.train.eval_freq)
+    full_train_eval_freq = int(getattr(conf.train, 'full_train_eval_freq', 0))
+    save_freq = int(conf.train.save_freq)
+    log_freq = max(int(conf.train.print_freq), 1)
+    # accumulate the training loss on device to avoid synchronizing with the device every step
+    train_loss_sum, n_train_steps = torch.zeros((), device=device), 0
     logger.info('Start training...')
-    while step < conf.train.n_steps:
+    while step < n_steps:
         for _batch in tqdm.tqdm(train_loader, desc='Epoch', leave=False):
-            if step >= conf.train.n_steps:
+            if step >= n_steps:
                 break
             # train a step
             model.train()
-            train_status = train_step(_batch)
-            status_tracker.track_status('Train', train_status, step)
+            train_loss_sum += train_step(_batch)
+            n_train_steps += 1
+            train_acc_ema_steps += 1
+            # track training status every `log_freq` steps
+            if check_freq(log_freq, step):
+                train_status = {
+                    'loss': (train_loss_sum / n_train_steps).item(),
+                    'acc@1(ema)': (train_acc_ema / (1 - 0.98 ** train_acc_ema_steps)).item(),
+                    'lr': optimizer.param_groups[0]['lr'],
+                }
+                status_tracker.track_status('Train', train_status, step)
+                train_loss_sum.zero_()
+                n_train_steps = 0
             # validate
             model.eval()
-            # evaluate
-            if check_freq(conf.train.eval_freq, step):
-                # evaluate on training set
+            run_full_train_eval, run_eval = check_freq(full_train_eval_freq, step), check_freq(eval_freq, step)
+            if run_full_train_eval or run_eval:
+                update_eval_model()
+            # evaluate on training set, which costs as much as an epoch and is disabled by default
+            if run_full_train_eval:
                 eval_status_train = evaluate(train_loader)
                 eval_status_train = {f'{k}(train_set)': v for k, v in eval_status_train.items()}
                 status_tracker.track_status('Eval', eval_status_train, step)
-                # evaluate on validation set
+            # evaluate on validation set
+            if run_eval:
                 eval_status_valid = evaluate(valid_loader)
                 eval_status_valid = {f'{k}(valid_set)': v for k, v in eval_status_valid.items()}
                 status_tracker.track_status('Eval', eval_status_valid, step)
@@ -178,13 +257,15 @@ def main():
                     best_acc = eval_status_valid['acc@1(valid_set)']
                     save_ckpt(os.path.join(exp_dir, 'ckpt', 'best'))
             # save checkpoint
-            if check_freq(conf.train.save_freq, step):
+            if check_freq(save_freq, step):
                 save_ckpt(os.path.join(exp_dir, 'ckpt', f'step{step:0>6d}'))
             step += 1
     # save the last checkpoint if not saved
-    if not check_freq(conf.train.save_freq, step - 1):
+    if not check_freq(save_freq, step - 1):
         save_ckpt(os.path.join(exp_dir, 'ckpt', f'step{step-1:0>6d}'))
     logger.info(f'Best valid accuracy: {best_acc:.4f}')
+    wait_for_ckpt()
+    ckpt_executor.shutdown()
 
     # END OF TRAINING
     status_tracker.close()
@@ -1,5 +1,6 @@
 """Miscellaneous utility functions."""
 
+import os
 import datetime
 import numpy as np
 import random
@@ -41,6 +42,24 @@ def set_seed(seed: int, deterministic: bool = False):
         torch.use_deterministic_algorithms(True)
 
 
+def copy_to_cpu(obj):
+    """Recursively copy all tensors in a (nested) dict / list / tuple to cpu, detached from the original storage."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: copy_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path: str):
+    """Save an object to a temporary file and rename it to `path`, so `path` is never partially written."""
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
 def query_yes_no(question: str, default: str = "yes"):
     """Ask a yes/no question.
 